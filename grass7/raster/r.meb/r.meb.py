@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 ########################################################################
@@ -106,6 +106,13 @@
 #% answer: 5
 #%end
 
+#%option
+#% key: nprocs
+#% type: integer
+#% description: Number of processes to run in parallel
+#% answer: 1
+#%end
+
 #----------------------------------------------------------------------------
 # Standard
 #----------------------------------------------------------------------------
@@ -116,17 +123,23 @@ import sys
 import csv
 import numpy as np
 import uuid
-import operator
 import atexit
+from multiprocessing import Pool
 import tempfile
-import string
 import grass.script as gs
+import grass.script.array as garray
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
+
+# Null value of CELL maps as returned by pygrass
+CELL_NULL = -2147483648
+
+# Number of rows read at once when processing the input layers
+BLOCK_ROWS = 1024
 
-# for Python 3 compatibility
-try:
-    xrange
-except NameError:
-    xrange = range
+# Maximum number of cells in the region for which the EB statistics are
+# computed in memory; for larger regions r.quantile is used instead
+MAX_CELLS_IN_MEMORY = 25000000
 
 # Rules
 COLORS_MES = """\
@@ -145,12 +158,13 @@ CLEAN_RAST = []
 
 def cleanup():
     """Remove temporary maps specified in the global list"""
-    for rast in CLEAN_RAST:
-        cf = gs.find_file(name=rast, element="cell",
-                          mapset=gs.gisenv()["MAPSET"])
-        if cf["fullname"] != "":
-            gs.run_command("g.remove", type="raster",
-                           name=rast, quiet=True, flags="f")
+    mapset = gs.gisenv()["MAPSET"]
+    existing = set(gs.list_strings(type="raster", mapset=mapset))
+    rast = [x for x in set(CLEAN_RAST)
+            if "{}@{}".format(x, mapset) in existing]
+    if rast:
+        gs.run_command("g.remove", type="raster", name=rast, quiet=True,
+                       flags="f")
 
 
 # Create temporary name
@@ -159,50 +173,155 @@ def tmpname(prefix):
     Store the name in the global list.
     Use only for raster maps.
     """
-    tmpf = prefix + str(uuid.uuid4())
-    tmpf = string.replace(tmpf, "-", "_")
+    tmpf = prefix + str(uuid.uuid4()).replace("-", "_")
     CLEAN_RAST.append(tmpf)
     return tmpf
 
 
 def raster_exists(envlay):
     """Check if the raster map exists, call GRASS fatal otherwise"""
-    for chl in xrange(len(envlay)):
-        ffile = gs.find_file(envlay[chl], element="cell")
-        if not ffile["fullname"]:
+    # Qualified names can refer to any mapset, bare names only to the
+    # mapsets in the search path
+    qualified = set(gs.list_strings(type="raster", mapset="*"))
+    bare = set([x.split("@")[0] for x in gs.list_strings(type="raster")])
+    for chl in range(len(envlay)):
+        if "@" in envlay[chl]:
+            found = envlay[chl] in qualified
+        else:
+            found = envlay[chl] in bare
+        if not found:
             gs.fatal(_("The layer {} does not exist").format(envlay[chl]))
 
 
-# Compute EB for input file (simlay = similarity, reflay = reference layer)
-def EB(simlay, reflay):
-    """Computation of the envirionmental bias and print to stdout"""
-    # Median and mad for whole region (within current mask)
-    tmpf4 = tmpname("reb4")
-    CLEAN_RAST.append(tmpf4)
-    d = gs.read_command("r.quantile", quiet=True, input=simlay,
-                        percentiles="50")
-    d = d.split(":")
-    d = float(string.replace(d[2], "\n", ""))
-    gs.mapcalc("$tmpf4 = abs($map - $d)",
-               map=simlay,
-               tmpf4=tmpf4,
-               d=d, quiet=True)
-    mad = gs.read_command("r.quantile", quiet=True, input=tmpf4,
-                          percentiles="50")
-    mad = mad.split(":")
-    mad = float(string.replace(mad[2], "\n", ""))
-    gs.run_command("g.remove", quiet=True, flags="f", type="raster",
-                   name=tmpf4)
-
-    # Median and mad for reference layer
-    tmpf5 = tmpname("reb5")
-    CLEAN_RAST.append(tmpf5)
-    gs.mapcalc("$tmpf5 = if($reflay==1, $simlay, null())", simlay=simlay,
-               tmpf5=tmpf5, reflay=reflay, quiet=True)
-    e = gs.read_command("r.quantile", quiet=True, input=tmpf5,
+def iter_blocks(mapname, block_rows=BLOCK_ROWS):
+    """Iterate over blocks of rows of a raster map in the current region.
+    Each block is returned as a float array, with null cells set to nan
+    """
+    name, unused, mapset = mapname.partition("@")
+    with RasterRow(name, mapset=mapset) as rast:
+        is_cell = rast.mtype == "CELL"
+        nrows = len(rast)
+        for start in range(0, nrows, block_rows):
+            block = np.array([rast.get_row(row) for row in
+                              range(start, min(start + block_rows, nrows))],
+                             dtype=np.float64)
+            if is_cell:
+                block[block == CELL_NULL] = np.nan
+            yield block
+
+
+def value_counts(values):
+    """Return the sorted unique values of an integer array and their counts.
+    Uses np.bincount when the values span a range not larger than the
+    number of values, np.unique otherwise
+    """
+    if values.size == 0:
+        return values, np.empty(0, dtype=np.int64)
+    vmin = values.min()
+    vrange = values.max() - vmin + 1
+    if vrange > values.size:
+        return np.unique(values, return_counts=True)
+    hist = np.bincount(values - vmin, minlength=vrange)
+    nz = np.nonzero(hist)[0]
+    return nz + vmin, hist[nz]
+
+
+def ies_from_counts(counts):
+    """Return the IES value for each value of a frequency table, given the
+    counts of the sorted values
+    """
+    # Cumulative percentages, converted to IES values
+    cum = np.cumsum(counts, dtype=np.float64)
+    c = cum / cum[-1] * 100.0
+    return np.where(c <= 50, 2 * c, np.where(c < 100, 2 * (100 - c), 0))
+
+
+# Compute IES for input layer (inplay = input, outlay = output IES layer)
+def compute_ies(params):
+    """Compute the environmental similarity (IES) of each cell of a layer
+    to the frequency distribution of values of that layer in the region.
+    The layer is read in blocks of rows; the frequency tables of the
+    blocks are merged once all blocks have been read
+    """
+    inplay, outlay, digits2 = params
+    if gs.raster_info(inplay)["datatype"] == "CELL":
+        digits2 = 1
+
+    # Calculate the frequency distribution of the input values,
+    # rounded to the given precision for non-integer layers, by merging
+    # the frequency tables of the blocks
+    bvals = []
+    bcounts = []
+    for block in iter_blocks(inplay):
+        scaled = np.rint(block[np.isfinite(block)] * digits2).astype(np.int64)
+        v, c = value_counts(scaled)
+        bvals.append(v)
+        bcounts.append(c)
+    del block, scaled
+    vals, inverse = np.unique(np.concatenate(bvals), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate(bcounts))
+    del bvals, bcounts, inverse
+    ies = ies_from_counts(counts)
+
+    # Create the IES layer, assigning the IES values to the cells of the
+    # input layer
+    with RasterRow(outlay, mode="w", mtype="DCELL") as new:
+        newrow = Buffer((gs.region()["cols"],), mtype="DCELL")
+        for block in iter_blocks(inplay):
+            valid = np.isfinite(block)
+            scaled = np.rint(block[valid] * digits2).astype(np.int64)
+            block[valid] = ies[np.searchsorted(vals, scaled)]
+            for row in block:
+                newrow[:] = row
+                new.put_row(newrow)
+    return outlay
+
+
+def quantile_median(mapname):
+    """Return the median of a raster map, computed with r.quantile"""
+    d = gs.read_command("r.quantile", quiet=True, input=mapname,
                         percentiles="50")
-    e = e.split(":")
-    e = float(string.replace(e[2], "\n", ""))
+    return float(d.split(":")[2].strip())
+
+
+# Compute EB for input file (simlay = similarity, reflay = reference layer,
+# refmask = reference area as boolean array)
+def EB(simlay, reflay, refmask=None):
+    """Computation of the envirionmental bias and print to stdout.
+    Without refmask, the medians are computed with r.quantile instead of
+    reading the layer into memory
+    """
+    if refmask is None:
+        # Median and mad for whole region (within current mask)
+        d = quantile_median(simlay)
+        tmpf4 = tmpname("reb4")
+        gs.mapcalc("$tmpf4 = abs($map - $d)", map=simlay, tmpf4=tmpf4,
+                   d=d, quiet=True)
+        mad = quantile_median(tmpf4)
+
+        # Median for reference area
+        tmpf5 = tmpname("reb5")
+        gs.mapcalc("$tmpf5 = if($reflay==1, $simlay, null())",
+                   simlay=simlay, tmpf5=tmpf5, reflay=reflay, quiet=True)
+        e = quantile_median(tmpf5)
+        gs.run_command("g.remove", quiet=True, flags="f", type="raster",
+                       name=(tmpf4, tmpf5))
+    else:
+        # Median and mad for whole region (within current mask)
+        layer = garray.array()
+        layer.read(simlay, null=np.nan)
+        valid = np.isfinite(layer)
+        # sim is a copy of the valid cells, so it can be modified in place
+        sim = layer[valid]
+        d = float(np.median(sim, overwrite_input=True))
+        sim -= d
+        np.abs(sim, out=sim)
+        mad = float(np.median(sim, overwrite_input=True))
+        del sim
+
+        # Median for reference area
+        e = float(np.median(layer[valid & refmask], overwrite_input=True))
+        del layer
     EBstat = abs(d - e) / mad
 
     # Print results to screen and return results
@@ -211,9 +330,6 @@ def EB(simlay, reflay):
     gs.info(_("MAD = {:.3f}").format(mad))
     gs.info(_("EB = {:.3f}").format(EBstat))
 
-    # Clean up and return data
-    gs.run_command("g.remove", flags="f", type="raster", name=tmpf5,
-                   quiet=True)
     return (mad, d, e, EBstat)
 
 
@@ -243,7 +359,10 @@ def main(options, flags):
     flag_o = flags["o"]
     flag_i = flags["i"]
     digits = int(options["digits"])
-    digits2 = pow(10, digits)
+    digits2 = 10 ** digits
+    nprocs = int(options["nprocs"])
+    if nprocs < 1:
+        gs.fatal(_("The number of processes (nprocs) should be at least 1"))
 
     # Check if ref map is of type cell and values are limited to 1 and 0
     reftype = gs.raster_info(ref)
@@ -255,9 +374,19 @@ def main(options, flags):
                    " (now the minimum is %d and maximum is %d)")
                  % (reftype['min'], reftype['max']))
 
+    # Read the reference area once, it is the same for all EB computations.
+    # For large regions the EB statistics are computed with r.quantile.
+    if int(gs.region()["cells"]) <= MAX_CELLS_IN_MEMORY:
+        reflay = garray.array()
+        reflay.read(ref, null=np.nan)
+        refmask = np.asarray(reflay == 1)
+        del reflay
+    else:
+        refmask = None
+
     # Text for history in metadata
-    opt2 = dict((k, v) for k, v in options.iteritems() if v)
-    hist = ' '.join("{!s}={!r}".format(k, v) for (k, v) in opt2.iteritems())
+    opt2 = dict((k, v) for k, v in options.items() if v)
+    hist = ' '.join("{!s}={!r}".format(k, v) for (k, v) in opt2.items())
     hist = "r.meb {}".format(hist)
     unused, tmphist = tempfile.mkstemp()
     text_file = open(tmphist, "w")
@@ -268,78 +397,56 @@ def main(options, flags):
     # Compute MES
     # ------------------------------------------------------------------------
 
-    # Create temporary copy of ref layer
-    tmpref0 = tmpname("reb1")
-    CLEAN_RAST.append(tmpref0)
-    gs.run_command("g.copy", quiet=True, raster=(ref, tmpref0))
-
-    ipi = []
-    for j in xrange(len(ipl)):
-        # Calculate the frequency distribution
-        tmpf1 = tmpname("reb1")
-        CLEAN_RAST.append(tmpf1)
-        laytype = gs.raster_info(ipl[j])["datatype"]
-        if laytype == "CELL":
-            gs.run_command("g.copy", quiet=True, raster=(ipl[j], tmpf1))
-        else:
-            gs.mapcalc("$tmpf1 = int($dignum * $inplay)", tmpf1=tmpf1,
-                       inplay=ipl[j], dignum=digits2, quiet=True)
-        p = gs.pipe_command("r.stats", quiet=True, flags="cn", input=tmpf1,
-                            sort="asc", sep=";")
-        stval = {}
-        for line in p.stdout:
-            [val, count] = line.strip(os.linesep).split(";")
-            stval[float(val)] = float(count)
-        p.wait()
-        sstval = sorted(stval.items(), key=operator.itemgetter(0))
-        sstval = np.matrix(sstval)
-        a = np.cumsum(np.array(sstval), axis=0)
-        b = np.sum(np.array(sstval), axis=0)
-        c = a[:, 1] / b[1] * 100
-
-        # Create recode rules
-        e1 = np.min(np.array(sstval), axis=0)[0] - 99999
-        e2 = np.max(np.array(sstval), axis=0)[0] + 99999
-        a1 = np.hstack([(e1), np.array(sstval.T[0])[0, :]])
-        a2 = np.hstack([np.array(sstval.T[0])[0, :] - 1, (e2)])
-        b1 = np.hstack([(0), c])
-
-        fd2, tmprule = tempfile.mkstemp()
-        text_file = open(tmprule, "w")
-        for k in np.arange(0, len(b1.T)):
-            text_file.write("{}:{}:{}\n".format(int(a1[k]), int(a2[k]), b1[k]))
-        text_file.close()
-
-        # Create the recode layer and calculate the IES
-        tmpf2 = tmpname("reb2")
-        CLEAN_RAST.append(tmpf2)
-        gs.run_command("r.recode", input=tmpf1, output=tmpf2, rules=tmprule)
-
-        tmpf3 = tmpname("reb3")
-        CLEAN_RAST.append(tmpf3)
-
-        calcc = "{1} = if({0} <= 50, 2 * float({0}), if({0} < 100, " \
-                "2 * (100 - float({0}))))".format(tmpf2, tmpf3)
-        gs.mapcalc(calcc, quiet=True)
-        gs.run_command("g.remove", quiet=True, flags="f", type="raster",
-                       name=(tmpf2, tmpf1))
-        os.close(fd2)
-        os.remove(tmprule)
-        ipi.append(tmpf3)
+    # The IES layers are independent, so they can be computed in parallel
+    ipi = [tmpname("reb3") for x in ipl]
+    jobs = [(ipl[j], ipi[j], digits2) for j in range(len(ipl))]
+    nprocs = min(nprocs, len(jobs))
+    if nprocs > 1:
+        pool = Pool(nprocs)
+        pool.map(compute_ies, jobs)
+        pool.close()
+        pool.join()
+    else:
+        for job in jobs:
+            compute_ies(job)
 
     # ----------------------------------------------------------------------
     # Calculate EB statistics
     # ----------------------------------------------------------------------
 
+    # Open the output file, rows are written as the EB values are computed
+    if filename:
+        csvfile = open(filename, "w", newline="")
+        atexit.register(csvfile.close)
+        fieldnames = ["variable", "median_region", "median_reference",
+                      "mad", "eb"]
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+
+    # Compute the selected MES layers in a single pass over the IES layers
+    mes_output = []
+    mes_method = []
+    for flag_x, suffix, method in ((flag_m, "mean", "average"),
+                                   (flag_n, "median", "median"),
+                                   (flag_o, "minimum", "minimum")):
+        if flag_x:
+            mes_output.append("{}_MES_{}".format(tmpf0, suffix))
+            mes_method.append(method)
+    gs.run_command("r.series", quiet=True, input=tuple(ipi),
+                   output=mes_output, method=mes_method)
+
     # EB MES
     if flag_m:
         gs.info(_("\nThe EB based on mean ES values:\n"))
         nmn = "{}_MES_mean".format(tmpf0)
-        gs.run_command("r.series", quiet=True, output=nmn, input=tuple(ipi),
-                       method="average")
         gs.write_command("r.colors", map=nmn, rules="-",
                          stdin=COLORS_MES, quiet=True)
-        ebm = EB(simlay=nmn, reflay=tmpref0)
+        ebm = EB(simlay=nmn, reflay=ref, refmask=refmask)
+        if filename:
+            writer.writerow({"variable": "MES_mean",
+                             "median_region": ebm[1],
+                             "median_reference": ebm[2],
+                             "mad": ebm[0], "eb": ebm[3]})
         if not out:
             # Add to list of layers to be removed at completion
             CLEAN_RAST.append(nmn)
@@ -355,11 +462,14 @@ def main(options, flags):
     if flag_n:
         gs.info(_("\nThe EB based on median ES values:\n"))
         nmn = "{}_MES_median".format(tmpf0)
-        gs.run_command("r.series", quiet=True, output=nmn, input=tuple(ipi),
-                       method="median")
         gs.write_command("r.colors", map=nmn, rules="-",
                          stdin=COLORS_MES, quiet=True)
-        ebn = EB(simlay=nmn, reflay=tmpref0)
+        ebn = EB(simlay=nmn, reflay=ref, refmask=refmask)
+        if filename:
+            writer.writerow({"variable": "MES_median",
+                             "median_region": ebn[1],
+                             "median_reference": ebn[2],
+                             "mad": ebn[0], "eb": ebn[3]})
         if not out:
             CLEAN_RAST.append(nmn)
         else:
@@ -374,11 +484,14 @@ def main(options, flags):
     if flag_o:
         gs.info(_("\nThe EB based on minimum ES values:\n"))
         nmn = "{}_MES_minimum".format(tmpf0)
-        gs.run_command("r.series", quiet=True, output=nmn, input=tuple(ipi),
-                       method="minimum")
         gs.write_command("r.colors", map=nmn, rules="-",
                          stdin=COLORS_MES, quiet=True)
-        ebo = EB(simlay=nmn, reflay=tmpref0)
+        ebo = EB(simlay=nmn, reflay=ref, refmask=refmask)
+        if filename:
+            writer.writerow({"variable": "MES_minimum",
+                             "median_region": ebo[1],
+                             "median_reference": ebo[2],
+                             "mad": ebo[0], "eb": ebo[3]})
         if not out:
             CLEAN_RAST.append(nmn)
         else:
@@ -392,8 +505,7 @@ def main(options, flags):
 
     # EB individual layers
     if flag_i:
-        ebi = {}
-        for mm in xrange(len(ipi)):
+        for mm in range(len(ipi)):
             nmn = "{}_{}".format(tmpf0, ipn[mm])
             if not out:
                 CLEAN_RAST.append(nmn)
@@ -401,8 +513,11 @@ def main(options, flags):
             gs.write_command("r.colors", map=nmn, rules="-",
                              stdin=COLORS_MES, quiet=True)
             gs.info(_("\nThe EB for {}:\n").format(ipn[mm]))
-            value = EB(simlay=nmn, reflay=tmpref0)
-            ebi[ipn[mm]] = value
+            ebj = EB(simlay=nmn, reflay=ref, refmask=refmask)
+            if filename:
+                writer.writerow({"variable": ipn[mm], "median_region": ebj[1],
+                                 "median_reference": ebj[2], "mad": ebj[0],
+                                 "eb": ebj[3]})
             gs.run_command("r.support", map=nmn,
                            title="Environmental similarity (ES) for "
                            "{}".format(ipn[mm]), units="0-100 (relative score",
@@ -414,33 +529,7 @@ def main(options, flags):
                        name=ipi)
 
     if filename:
-        with open(filename, "wb") as csvfile:
-            fieldnames = ["variable", "median_region", "median_reference",
-                          "mad", "eb"]
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-            if flag_m:
-                writer.writerow({"variable": "MES_mean",
-                                 "median_region": ebm[1],
-                                 "median_reference": ebm[2],
-                                 "mad": ebm[0], "eb": ebm[3]})
-            if flag_n:
-                writer.writerow({"variable": "MES_median",
-                                 "median_region": ebn[1],
-                                 "median_reference": ebn[2],
-                                 "mad": ebn[0], "eb": ebn[3]})
-            if flag_o:
-                writer.writerow({"variable": "MES_minimum",
-                                 "median_region": ebo[1],
-                                 "median_reference": ebo[2],
-                                 "mad": ebo[0], "eb": ebo[3]})
-            if flag_i:
-                mykeys = ebi.keys()
-                for vari in mykeys:
-                    ebj = ebi[vari]
-                    writer.writerow({"variable": vari, "median_region": ebj[1],
-                                     "median_reference": ebj[2], "mad": ebj[0],
-                                     "eb": ebj[3]})
+        csvfile.close()
         gs.info(_("\nThe results are written to {}\n").format(filename))
         gs.info("\n")
 
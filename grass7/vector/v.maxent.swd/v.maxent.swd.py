@@ -168,6 +168,7 @@ import numpy as np
 import string
 import uuid
 import atexit
+import itertools
 import tempfile
 
 #----------------------------------------------------------------------------
@@ -193,16 +194,14 @@ def tmpname(name):
     return tmpf
 
 def CreateFileName(outputfile):
-    flname = outputfile
-    k = 0
-    while os.path.isfile(flname):
-        k = k + 1
-        fn = flname.split('.')
-        if len(fn) == 1:
-            flname = fn[0] + "_" + str(k)
+    base, ext = os.path.splitext(outputfile)
+    for k in itertools.count():
+        if k == 0:
+            flname = outputfile
         else:
-            flname = fn[0] + "_" + str(k) + "." + fn[1]
-    return flname
+            flname = base + "_" + str(k) + ext
+        if not os.path.isfile(flname):
+            return flname
 
 #----------------------------------------------------------------------------
 # Main